@@ -4,18 +4,26 @@
 # DeepSpeed Team
 
 import argparse
+import array
 import asyncio
+import copy
 import json
 import multiprocessing
+import multiprocessing.connection
 import os
+import pickle
 import queue
 import random
-import requests
+import struct
 import threading
 import time
-from typing import List, Iterable, Union
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, AsyncIterator, Callable, List, Tuple, Union
 
+import aiohttp
 import numpy as np
+import orjson
 from transformers import AutoTokenizer
 
 try:
@@ -30,6 +38,69 @@ except ImportError:
     from utils import parse_args, print_summary, get_args_product, CLIENT_PARAMS
 
 
+# Upper bound on the UTF-8 size of a single prompt token, used to size the
+# shared-memory slots that carry prompts to the client processes
+MAX_BYTES_PER_TOKEN = 16
+
+
+class SHMRing:
+    """
+    FIFO of fixed-size slots in shared memory. Payloads are pickled straight
+    into a slot, so there is no feeder thread or pipe between the producer and
+    the consumers as there is with multiprocessing.Queue. The interface mirrors
+    the subset of queue.Queue used by the clients.
+    """
+
+    _HEADER = struct.Struct("I")
+
+    def __init__(self, slots: int, slot_bytes: int):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self._stride = self._HEADER.size + slot_bytes
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * self._stride)
+        self._head = multiprocessing.Value("Q", 0)
+        self._tail = multiprocessing.Value("Q", 0)
+        self._empty = multiprocessing.Semaphore(slots)
+        self._full = multiprocessing.Semaphore(0)
+
+    def serialize(self, item: Any) -> bytes:
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_bytes:
+            raise ValueError(
+                f"Payload of {len(data)} bytes does not fit in a {self.slot_bytes} byte slot"
+            )
+        return data
+
+    def put(self, item: Any) -> None:
+        self.put_serialized(self.serialize(item))
+
+    def put_serialized(self, data: bytes) -> None:
+        self._empty.acquire()
+        with self._tail.get_lock():
+            offset = (self._tail.value % self.slots) * self._stride
+            self._HEADER.pack_into(self._shm.buf, offset, len(data))
+            start = offset + self._HEADER.size
+            self._shm.buf[start : start + len(data)] = data
+            self._tail.value += 1
+        self._full.release()
+
+    def get(self, timeout: Union[None, float] = None) -> Any:
+        if not self._full.acquire(timeout=timeout):
+            raise queue.Empty
+        with self._head.get_lock():
+            offset = (self._head.value % self.slots) * self._stride
+            (size,) = self._HEADER.unpack_from(self._shm.buf, offset)
+            start = offset + self._HEADER.size
+            data = bytes(self._shm.buf[start : start + size])
+            self._head.value += 1
+        self._empty.release()
+        return pickle.loads(data)
+
+    def close(self) -> None:
+        self._shm.close()
+        self._shm.unlink()
+
+
 def call_fastgen(
     input_tokens: str, max_new_tokens: int, args: argparse.Namespace
 ) -> ResponseDetails:
@@ -38,27 +109,25 @@ def call_fastgen(
     client = mii.client(args.deployment_name)
 
     output_tokens = []
-    token_gen_time = []
-    time_last_token = 0
+    # Raw monotonic timestamps (ns); deltas are computed once generation is done
+    # to keep the streaming callback as cheap as possible
+    token_times = array.array("q")
+    token_times_append = token_times.append
 
     def callback(response):
-        nonlocal time_last_token
-        # print(f"Received: {response[0].generated_text} time_last_token={time_last_token}")
         output_tokens.append(response[0].generated_text)
-        time_now = time.time()
-        token_gen_time.append(time_now - time_last_token)
-        time_last_token = time_now
+        token_times_append(time.perf_counter_ns())
 
-    time_last_token = start_time = time.time()
-    token_gen_time = []
+    start_time = time.time()
+    token_times_append(time.perf_counter_ns())
     if args.stream:
-        output_tokens = []
         client.generate(
             input_tokens, max_new_tokens=max_new_tokens, streaming_fn=callback
         )
     else:
         result = client.generate(input_tokens, max_new_tokens=max_new_tokens)
         output_tokens = result[0].generated_text
+    token_gen_time = (np.diff(np.frombuffer(token_times, dtype=np.int64)) * 1e-9).astype(np.float32)
 
     return ResponseDetails(
         generated_tokens=output_tokens,
@@ -70,7 +139,7 @@ def call_fastgen(
     )
 
 
-def call_vllm(
+async def call_vllm(
     input_tokens: str, max_new_tokens: int, args: argparse.Namespace
 ) -> ResponseDetails:
     if not args.stream:
@@ -95,34 +164,50 @@ def call_vllm(
         for _ in range(n):
             print(LINE_UP, end=LINE_CLEAR, flush=True)
 
-    def get_streaming_response(
-        response: requests.Response, time_last_token
-    ) -> Iterable[List[str]]:
-        for chunk in response.iter_lines(
-            chunk_size=8192, decode_unicode=False, delimiter=b"\0"
-        ):
-            if chunk:
-                data = json.loads(chunk.decode("utf-8"))
-                output = data["text"][0]
-                time_now = time.time()
-                yield output, time_now - time_last_token
-                time_last_token = time_now
+    async def get_streaming_response(
+        response: aiohttp.ClientResponse, time_last_token
+    ) -> AsyncIterator[Tuple[str, float]]:
+        # Responses are null-delimited JSON frames that may be split across
+        # (or packed into) network chunks. Each frame carries the prompt plus
+        # all text generated so far and is emitted once per new token, so the
+        # new token is whatever follows the previous frame's text.
+        buffer = b""
+        prev_len = len(input_tokens)
+        async for chunk in response.content.iter_chunked(8192):
+            time_now = time.perf_counter()
+            *frames, buffer = (buffer + chunk).split(b"\0")
+            for frame in frames:
+                if frame:
+                    data = orjson.loads(frame)
+                    output = data["text"][0]
+                    yield output[prev_len:], time_now - time_last_token
+                    prev_len = len(output)
+                    time_last_token = time_now
 
     # For non-streaming, but currently non-streaming is not fully implemented
-    def get_response(response: requests.Response) -> List[str]:
-        data = json.loads(response.content)
+    def get_response(content: bytes) -> List[str]:
+        data = json.loads(content)
         output = data["text"]
         return output
 
-    token_gen_time = []
+    output_tokens = []
+    token_gen_time = np.empty(max_new_tokens, dtype=np.float32)
+    num_frames = 0
     start_time = time.time()
-    response = requests.post(api_url, headers=headers, json=pload, stream=args.stream)
-    for h, t in get_streaming_response(response, start_time):
-        output = h
-        token_gen_time.append(t)
+    # Start the token clock before sending so the first token time includes
+    # connection, upload and any server delay before the response headers
+    t_start = time.perf_counter()
+    async with args._session.post(api_url, headers=headers, json=pload) as response:
+        async for h, t in get_streaming_response(response, t_start):
+            output_tokens.append(h)
+            if num_frames == len(token_gen_time):
+                token_gen_time = np.resize(token_gen_time, 2 * num_frames + 1)
+            token_gen_time[num_frames] = t
+            num_frames += 1
+    token_gen_time = token_gen_time[:num_frames]
 
     return ResponseDetails(
-        generated_tokens=output,
+        generated_tokens=output_tokens,
         prompt=input_tokens,
         start_time=start_time,
         end_time=time.time(),
@@ -131,7 +216,7 @@ def call_vllm(
     )
 
 
-def call_aml(
+async def call_aml(
     input_tokens: str,
     max_new_tokens: int,
     args: argparse.Namespace,
@@ -157,8 +242,8 @@ def call_aml(
         }
     }
 
-    def get_response(response: requests.Response) -> List[str]:
-        data = json.loads(response.content)
+    def get_response(content: bytes) -> List[str]:
+        data = json.loads(content)
         try:
             output = data[0]["0"]
         except (KeyError, TypeError):
@@ -168,20 +253,24 @@ def call_aml(
                 output = data
         return output
 
-    token_gen_time = []
-    response = None
+    token_gen_time = np.empty(0, dtype=np.float32)
+    status, content = None, None
+    timeout = aiohttp.ClientTimeout(total=180)
     if start_time is None:
         start_time = time.time()
     while True:
         try: # Sometimes the AML endpoint will return an error, so we send the request again
-            response = requests.post(args.aml_api_url, headers=headers, json=pload, timeout=180)
-            output = get_response(response)
+            async with args._session.post(
+                args.aml_api_url, headers=headers, json=pload, timeout=timeout
+            ) as response:
+                status, content = response.status, await response.read()
+            output = get_response(content)
             break
         except Exception as e:
             print(f"Connection failed with {e}. Retrying AML request")
             # make sure response exist before we call it
-            if response:
-                print(f"{response.status_code}:{response.content}")
+            if content is not None:
+                print(f"{status}:{content}")
 
     return ResponseDetails(
         generated_tokens=output,
@@ -193,10 +282,39 @@ def call_aml(
     )
 
 
+async def _create_session() -> aiohttp.ClientSession:
+    # One keep-alive connection pool per client so that connection setup is
+    # not part of the measured request latency. Streamed generations can run
+    # for a long time, so only connecting is time-limited (call_aml sets its
+    # own per-request timeout).
+    connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def _get_client_setup(args: argparse.Namespace) -> Tuple[Callable, int]:
+    # Backend call function, and how many completed requests between progress reports
+    backend_call_fns = {"fastgen": call_fastgen, "vllm": call_vllm, "aml": call_aml}
+    return backend_call_fns[args.backend], max(1, args.num_requests // 20)
+
+
+def _call_backend(
+    call_fn: Callable,
+    event_loop: asyncio.AbstractEventLoop,
+    input_tokens: str,
+    max_new_tokens: int,
+    args: argparse.Namespace,
+) -> ResponseDetails:
+    if asyncio.iscoroutinefunction(call_fn):
+        return event_loop.run_until_complete(call_fn(input_tokens, max_new_tokens, args))
+    return call_fn(input_tokens, max_new_tokens, args)
+
+
 def _run_parallel(
     barrier: Union[threading.Barrier, multiprocessing.Barrier],
-    query_queue: Union[queue.Queue, multiprocessing.Queue],
-    result_queue: Union[queue.Queue, multiprocessing.Queue],
+    query_queue: Union[queue.Queue, SHMRing],
+    result_queue: Union[queue.Queue, multiprocessing.connection.Connection],
+    progress: multiprocessing.Value,
     args: argparse.Namespace,
 ):
     pid = os.getpid()
@@ -205,82 +323,114 @@ def _run_parallel(
     event_loop = asyncio.new_event_loop()
     asyncio.set_event_loop(event_loop)
 
-    backend_call_fns = {"fastgen": call_fastgen, "vllm": call_vllm, "aml": call_aml}
-    call_fn = backend_call_fns[args.backend]
+    call_fn, progress_interval = _get_client_setup(args)
+    use_session = asyncio.iscoroutinefunction(call_fn)
+
+    # Threads share the args object, so each client keeps its session on a copy
+    args = copy.copy(args)
+    if use_session:
+        args._session = event_loop.run_until_complete(_create_session())
+    # Threads share a queue.Queue, processes each have their own result pipe
+    if isinstance(result_queue, queue.Queue):
+        send_result = result_queue.put
+    else:
+        send_result = result_queue.send
 
     barrier.wait()
 
     for _ in range(args.warmup):
-        print(f"warmup queue size: {query_queue.qsize()} ({pid})", flush=True)
         input_tokens, req_max_new_tokens = query_queue.get(timeout=1.0)
-        _ = call_fn(input_tokens, req_max_new_tokens, args)
+        _ = _call_backend(call_fn, event_loop, input_tokens, req_max_new_tokens, args)
 
     barrier.wait()
 
     time.sleep(random.uniform(0, args.num_clients) * 0.01)
     try:
         while True:
-            print(f"queue size: {query_queue.qsize()} ({pid})", flush=True)
             input_tokens, req_max_new_tokens = query_queue.get(timeout=1.0)
 
-            r = call_fn(input_tokens, req_max_new_tokens, args)
+            r = _call_backend(call_fn, event_loop, input_tokens, req_max_new_tokens, args)
+
+            send_result(r)
 
-            result_queue.put(r)
+            with progress.get_lock():
+                progress.value += 1
+                num_done = progress.value
+            if num_done % progress_interval == 0:
+                print(f"requests done: {num_done}/{args.num_requests} ({pid})")
     except queue.Empty:
         print(f"queue is empty ({pid})")
 
+    if use_session:
+        event_loop.run_until_complete(args._session.close())
+    event_loop.close()
+
     print(f"Worker ({pid}) finished. session_id: {session_id}")
 
 
-def run_client(args):
+async def _run_async_clients(
+    queries: List[Tuple[str, int]], args: argparse.Namespace
+) -> List[ResponseDetails]:
     """
-    Run MII client for benchmarking. The scenario is a bit complicated:
-    1. The main process puts `num_requests` queries into the input queue
-    2. Each client runs `warmup` iterations () taking the queries from the input queue
-    3. --- barrier ---
-    4. The main process marks the start time
-    5a. All clients send `num_requests' query in total and put the results into the result queue
-    5b. The main process takes the results from the result queue (in parallel with 5a)
-    6. The main process marks the end time after receiving `num_requests' results
+    Run all clients as coroutines on the current event loop. HTTP backends are
+    awaited directly; blocking backends (fastgen) run on a dedicated executor
+    thread per client so their streaming callbacks never wait on the loop.
     """
+    loop = asyncio.get_running_loop()
 
-    if args.use_thread:
-        runnable_cls = threading.Thread
-        barrier_cls = threading.Barrier
-        queue_cls = queue.Queue
-    else:
-        runnable_cls = multiprocessing.Process
-        barrier_cls = multiprocessing.Barrier
-        queue_cls = multiprocessing.Queue
+    call_fn, progress_interval = _get_client_setup(args)
+    use_session = asyncio.iscoroutinefunction(call_fn)
 
-    barrier = barrier_cls(args.num_clients + 1)
-    query_queue = queue_cls()
-    result_queue = queue_cls()
+    args = copy.copy(args)
+    if use_session:
+        args._session = await _create_session()
+    executor = ThreadPoolExecutor(max_workers=args.num_clients)
 
-    processes = [
-        runnable_cls(
-            target=_run_parallel,
-            args=(
-                barrier,
-                query_queue,
-                result_queue,
-                args,
-            ),
+    async def call(input_tokens: str, max_new_tokens: int) -> ResponseDetails:
+        if use_session:
+            return await call_fn(input_tokens, max_new_tokens, args)
+        return await loop.run_in_executor(
+            executor, call_fn, input_tokens, max_new_tokens, args
         )
-        for i in range(args.num_clients)
-    ]
-    for p in processes:
-        p.start()
 
+    query_queue = asyncio.Queue()
+    for q in queries:
+        query_queue.put_nowait(q)
+
+    async def warmup() -> None:
+        for _ in range(args.warmup):
+            await call(*query_queue.get_nowait())
+
+    response_details = []
+
+    async def client() -> None:
+        while not query_queue.empty():
+            response_details.append(await call(*query_queue.get_nowait()))
+            if len(response_details) % progress_interval == 0:
+                print(f"requests done: {len(response_details)}/{args.num_requests}")
+
+    try:
+        await asyncio.gather(*(warmup() for _ in range(args.num_clients)))
+        await asyncio.gather(*(client() for _ in range(args.num_clients)))
+    finally:
+        if use_session:
+            await args._session.close()
+        executor.shutdown()
+
+    return response_details
+
+
+def _get_queries(args: argparse.Namespace, num_queries: int) -> List[Tuple[str, int]]:
     tokenizer = AutoTokenizer.from_pretrained(args.model)
     query_generator = RandomQueryGenerator(all_text, tokenizer, seed=42)
     request_text = query_generator.get_random_request_text(
         args.mean_prompt_length,
         args.mean_prompt_length * args.prompt_length_var,
         args.max_prompt_length,
-        args.num_requests + args.warmup * args.num_clients,
+        num_queries,
     )
 
+    queries = []
     for t in request_text:
         # Set max_new_tokens following normal distribution
         req_max_new_tokens = int(
@@ -289,27 +439,151 @@ def run_client(args):
                 args.max_new_tokens_var * args.mean_max_new_tokens,
             )
         )
-        query_queue.put((t, req_max_new_tokens))
+        queries.append((t, req_max_new_tokens))
+    return queries
 
-    # Tokenizers must be initialized after fork.
-    # So we need to fork before putting inputs to the queue.
-    # We need this barrier to stop child processse from taking inputs before the main process puts them
-    barrier.wait()
-    # This barrier is to make sure that all clients have finished warmup
-    barrier.wait()
+
+def _run_clients(
+    args: argparse.Namespace,
+    query_queue: Union[queue.Queue, SHMRing],
+    runnable_cls: type,
+    barrier: Union[threading.Barrier, multiprocessing.Barrier],
+    num_queries: int,
+) -> List[ResponseDetails]:
+    if args.use_thread:
+        # Threads pass results through a plain queue, without pickling
+        result_queue = queue.Queue()
+        client_results = [result_queue] * args.num_clients
+    else:
+        # One pipe per process so that results are sent without a shared lock
+        result_pipes, client_results = zip(
+            *(multiprocessing.Pipe(duplex=False) for _ in range(args.num_clients))
+        )
+    progress = multiprocessing.Value("i", 0)
+
+    processes = [
+        runnable_cls(
+            target=_run_parallel,
+            args=(
+                barrier,
+                query_queue,
+                client_results[i],
+                progress,
+                args,
+            ),
+        )
+        for i in range(args.num_clients)
+    ]
+    for p in processes:
+        p.start()
+    if not args.use_thread:
+        # Drop the parent's copies of the write ends so that a pipe reports
+        # EOF as soon as its client process exits
+        for conn in client_results:
+            conn.close()
+
+    try:
+        queries = _get_queries(args, num_queries)
+        num_warmup = args.warmup * args.num_clients
+
+        if isinstance(query_queue, SHMRing):
+            # Serialize every query up front so that an oversized prompt fails here,
+            # in the main thread, rather than in the feeder thread below
+            queries = [query_queue.serialize(q) for q in queries]
+            put_query = query_queue.put_serialized
+        else:
+            put_query = query_queue.put
+
+        # Tokenizers must be initialized after fork.
+        # So we need to fork before putting inputs to the queue.
+        # We need this barrier to stop child processse from taking inputs before the main process puts the warmup queries
+        for query in queries[:num_warmup]:
+            put_query(query)
+        barrier.wait()
+        # The remaining queries are fed from a separate thread, starting while the
+        # clients warm up, since the query ring can be smaller than the number of
+        # requests. The queue is FIFO, so warmup only ever takes the warmup queries.
+        def feed_queries():
+            for query in queries[num_warmup:]:
+                put_query(query)
+
+        feeder = threading.Thread(target=feed_queries, daemon=True)
+        feeder.start()
+        # This barrier is to make sure that all clients have finished warmup
+        barrier.wait()
+    except BaseException:
+        # Release clients waiting at the barrier so they exit instead of hanging
+        barrier.abort()
+        raise
 
     response_details = []
+    open_pipes = [] if args.use_thread else list(result_pipes)
     while len(response_details) < args.num_requests:
-        res = result_queue.get()
-        # vLLM returns concatinated tokens
-        if args.backend == "vllm":
-            all_tokens = tokenizer.tokenize(res.generated_tokens)
-            res.generated_tokens = all_tokens[len(tokenizer.tokenize(res.prompt)) :]
-        response_details.append(res)
+        if args.use_thread:
+            response_details.append(result_queue.get())
+            continue
+        if not open_pipes:
+            raise RuntimeError(
+                f"All clients exited after returning {len(response_details)} of {args.num_requests} results"
+            )
+        for pipe in multiprocessing.connection.wait(open_pipes):
+            try:
+                response_details.append(pipe.recv())
+            except EOFError:
+                open_pipes.remove(pipe)
+
+    feeder.join()
+    for p in processes:
+        p.join()
 
     return response_details
 
 
+def run_client(args):
+    """
+    Run MII client for benchmarking. The scenario is a bit complicated:
+    1. The main process puts the warmup queries into the input queue
+    2. Each client runs `warmup` iterations () taking the queries from the input queue,
+       while a feeder thread in the main process starts putting the remaining `num_requests` queries into it
+    3. --- barrier ---
+    4. The main process marks the start time
+    5a. All clients send `num_requests' query in total and send the results back
+        (through a shared result queue for threads, through one pipe per client for processes)
+    5b. The main process receives the results (in parallel with 5a)
+    6. The main process marks the end time after receiving `num_requests' results
+
+    With `use_asyncio`, all clients instead run as coroutines in the main process.
+    """
+
+    num_queries = args.num_requests + args.warmup * args.num_clients
+
+    if args.use_asyncio:
+        return asyncio.run(_run_async_clients(_get_queries(args, num_queries), args))
+
+    if args.use_thread:
+        runnable_cls = threading.Thread
+        barrier_cls = threading.Barrier
+        query_queue = queue.Queue()
+    else:
+        runnable_cls = multiprocessing.Process
+        barrier_cls = multiprocessing.Barrier
+        # The ring holds all warmup queries plus a couple of queries per client,
+        # so its size depends on the number of clients, not of requests. Each
+        # slot has room for a prompt plus the pickle overhead of the (text, int) tuple.
+        query_queue = SHMRing(
+            slots=(args.warmup + 2) * args.num_clients,
+            slot_bytes=args.max_prompt_length * MAX_BYTES_PER_TOKEN + 64,
+        )
+
+    try:
+        return _run_clients(
+            args, query_queue, runnable_cls, barrier_cls(args.num_clients + 1), num_queries
+        )
+    finally:
+        if isinstance(query_queue, SHMRing):
+            query_queue.close()
+
+
 if __name__ == "__main__":
     args = parse_args(client_args=True)
 
@@ -8,12 +8,17 @@ import glob
 import os
 import re
 import yaml
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+import orjson
 
-from postprocess_results import read_json, get_summary, get_result_sets
+from postprocess_results import get_summary, get_result_sets, ResponseDetails
 
 
 def get_args():
@@ -26,24 +31,37 @@ def get_args():
     return args
 
 
+def _load_one(file_path):
+    with open(file_path, "rb") as f:
+        return orjson.loads(f.read())
+
+
 def extract_values(file_pattern):
     files = glob.glob(file_pattern)
 
     print(f"Found {len(files)}")
     print("\n".join(files))
 
+    # Only file reads and JSON parsing run on the pool; the summaries tokenize
+    # text, which is CPU-bound and shares one lazily created tokenizer
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        all_data = list(executor.map(_load_one, files))
+
+    if not all_data:
+        return np.array([]), np.array([]), np.array([]), None
+
     clients = []
     throughputs = []
     latencies = []
-    extra_args = {}
-    for f in files:
-        prof_args, response_details = read_json(f)
+    for data in all_data:
+        prof_args = data["args"]
+        response_details = [ResponseDetails(**r) for r in data["response_details"]]
         summary = get_summary(prof_args, response_details)
         clients.append(prof_args["num_clients"])
         throughputs.append(summary.throughput)
         latencies.append(summary.latency)
 
-    return clients, throughputs, latencies, prof_args
+    return np.asarray(clients), np.asarray(throughputs), np.asarray(latencies), prof_args
 
 
 def output_charts(model, tp_size, bs, replicas, prompt, gen, out_dir):
@@ -52,6 +70,15 @@ def output_charts(model, tp_size, bs, replicas, prompt, gen, out_dir):
     result_file_pattern = f"{model}-tp{tp_size}-bs{bs}-replicas{replicas}-prompt{prompt}-gen{gen}-clients*.json"
 
     plt.figure()
+    ax = plt.gca()
+    color_cycle = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+
+    # Points are grouped by marker and fit lines gathered into a single
+    # collection so that each chart has a handful of artists regardless of
+    # how many data directories are plotted
+    points = defaultdict(lambda: ([], [], []))
+    fit_segments, fit_colors, fit_linestyles = [], [], []
+    legend_handles = []
 
     for data_dir in args.data_dirs:
         file_pattern = f"{data_dir}/{result_file_pattern}"
@@ -60,19 +87,19 @@ def output_charts(model, tp_size, bs, replicas, prompt, gen, out_dir):
         kwargs = {}
         kwargs["label"] = str(data_dir)
         kwargs["marker"] = "o"
-        kwargs["linestyle"] = "--"
 
         fit_kwargs = {}
         fit_kwargs["linestyle"] = "--"
         plot_fit_line = True
 
         polyfit_degree = 3
-        plot_fn = plt.scatter
 
         plot_config = glob.glob(f"{data_dir}/plot_config.yaml")
 
-        latencies = sorted(latencies)
-        throughputs = sorted(throughputs)
+        # Sort by throughput, keeping each latency paired with its throughput
+        order = np.argsort(throughputs, kind="stable")
+        throughputs = throughputs[order]
+        latencies = latencies[order]
 
         if plot_config:
             plot_config = plot_config[0]
@@ -81,19 +108,15 @@ def output_charts(model, tp_size, bs, replicas, prompt, gen, out_dir):
 
             # If x_max specified, clip data
             if "x_max" in plot_keys:
-                for i, throughput in enumerate(throughputs):
-                    if throughput > plot_config["x_max"]:
-                        latencies = latencies[:i]
-                        throughputs = throughputs[:i]
-                        break
+                mask = throughputs <= plot_config["x_max"]
+                throughputs = throughputs[mask]
+                latencies = latencies[mask]
 
             # If y_max specified, clip data
             if "y_max" in plot_keys:
-                for i, latency in enumerate(latencies):
-                    if latency > plot_config["y_max"]:
-                        latencies = latencies[:i]
-                        throughputs = throughputs[:i]
-                        break
+                mask = latencies <= plot_config["y_max"]
+                throughputs = throughputs[mask]
+                latencies = latencies[mask]
 
             # Set polyfit degree
             polyfit_degree = plot_config.get("polyfit_degree", polyfit_degree)
@@ -109,8 +132,6 @@ def output_charts(model, tp_size, bs, replicas, prompt, gen, out_dir):
                 kwargs["marker"] = plot_config["marker"]
             if "color" in plot_keys:
                 kwargs["color"] = plot_config["color"]
-            if "linestyle" in plot_keys:
-                kwargs["linestyle"] = plot_config["linestyle"]
 
             # Fit line kwargs
             if "color" in plot_keys:
@@ -119,31 +140,46 @@ def output_charts(model, tp_size, bs, replicas, prompt, gen, out_dir):
                 fit_kwargs["linestyle"] = plot_config["linestyle"]
 
         if len(throughputs) > 0:
-            plot = plot_fn(
-                throughputs,
-                latencies,
-                **kwargs,
+            plot_color = kwargs.get(
+                "color", color_cycle[len(legend_handles) % len(color_cycle)]
+            )
+            xs, ys, colors = points[kwargs["marker"]]
+            xs.append(throughputs)
+            ys.append(latencies)
+            colors.extend([plot_color] * len(throughputs))
+            legend_handles.append(
+                Line2D(
+                    [], [],
+                    color=plot_color,
+                    marker=kwargs["marker"],
+                    linestyle="none",
+                    label=kwargs["label"],
+                )
             )
-
-            if plot_fn == plt.plot:
-                plot_color = plot[0].get_color()
-            else:
-                plot_color = plot.get_facecolor()[0]
 
             if not "color" in fit_kwargs.keys():
                 fit_kwargs["color"] = plot_color
 
-            fit_x_list = np.arange(min(throughputs), max(throughputs), 0.01)
-            data_model = np.polyfit(throughputs, latencies, polyfit_degree)
-            model_fn = np.poly1d(data_model)
-            x = fit_x_list if plot_fit_line else throughputs
-            y = model_fn(fit_x_list) if plot_fit_line else latencies
-            plt.plot(
-                x,
-                y,
-                alpha=0.5,
-                **fit_kwargs,
-            )
+            if plot_fit_line:
+                # Throughputs are sorted, so the endpoints are the min and max
+                x = np.linspace(throughputs[0], throughputs[-1], 512)
+                coeffs = np.polyfit(throughputs, latencies, polyfit_degree)[::-1]
+                y = np.polynomial.polynomial.polyval(x, coeffs)
+            else:
+                x = throughputs
+                y = latencies
+            fit_segments.append(np.column_stack((x, y)))
+            fit_colors.append(fit_kwargs["color"])
+            fit_linestyles.append(fit_kwargs["linestyle"])
+
+    for marker, (xs, ys, colors) in points.items():
+        ax.scatter(np.concatenate(xs), np.concatenate(ys), c=colors, marker=marker)
+    ax.add_collection(
+        LineCollection(
+            fit_segments, colors=fit_colors, linestyles=fit_linestyles, alpha=0.5
+        )
+    )
+    ax.autoscale_view()
 
     # Generic plot formatting
     if args.model_name:
@@ -154,7 +190,7 @@ def output_charts(model, tp_size, bs, replicas, prompt, gen, out_dir):
     plt.title(f"Model: {model_label}, Prompt: {prompt}, Generation: {gen}, TP: {tp_size}")
     plt.xlabel("Throughput (queries/s)", fontsize=14)
     plt.ylabel("Latency (s)", fontsize=14)
-    plt.legend()
+    plt.legend(handles=legend_handles)
     plt.grid(True)
     plt.tight_layout()
     out_file = (
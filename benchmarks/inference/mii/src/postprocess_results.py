@@ -9,7 +9,6 @@ import re
 import os
 from tabulate import tabulate
 from dataclasses import dataclass
-from functools import reduce
 from pathlib import Path
 from statistics import mean
 from typing import List
@@ -29,7 +28,35 @@ class ResponseDetails:
     start_time: float
     end_time: float
     model_time: float
-    token_gen_time: List[float]
+    token_gen_time: np.ndarray
+
+    def __post_init__(self):
+        # Per-token times are kept as compact float32 arrays (seconds), both
+        # when sent from the clients and when loaded back from JSON
+        self.token_gen_time = np.asarray(self.token_gen_time, dtype=np.float32)
+
+    @property
+    def ttft(self) -> float:
+        """Time to first token. Non-streamed responses have no per-token times,
+        so their first token arrives with the full response."""
+        if len(self.token_gen_time) == 0:
+            return self.end_time - self.start_time
+        return float(self.token_gen_time[0])
+
+    @property
+    def tbt(self) -> np.ndarray:
+        """Time between each token and the previous one, from the second token on."""
+        return self.token_gen_time[1:]
+
+    @property
+    def t_second(self) -> float:
+        """Time to second token. Like ttft, this is the full request latency for
+        non-streamed responses, and nan if only one token was streamed."""
+        if len(self.token_gen_time) == 0:
+            return self.end_time - self.start_time
+        if len(self.token_gen_time) < 2:
+            return float("nan")
+        return float(self.token_gen_time[0] + self.token_gen_time[1])
 
 
 @dataclass
@@ -86,20 +113,13 @@ def get_summary(args, response_details):
         ]
     )
 
-    # For non-streaming results, we don't have any token_gen_time information
-    first_token_latency = 0.0
+    # Prefill and decode are reported separately. Non-streamed results have no
+    # time between tokens, and their first token arrives with the full response.
+    first_token_latency = float(np.mean([r.ttft for r in response_details]))
     token_gen_latency = 0.0
-    if response_details[0].token_gen_time:
-        first_token_latency = mean([r.token_gen_time[0] for r in response_details])
-        token_gen_latency_flat = reduce(
-            list.__add__,
-            [
-                r.token_gen_time[1:-1]
-                for r in response_details
-                if len(r.token_gen_time) > 2
-            ],
-        )
-        token_gen_latency = mean([t for t in token_gen_latency_flat])
+    token_gen_latency_flat = [r.tbt[:-1] for r in response_details if len(r.tbt) > 1]
+    if token_gen_latency_flat:
+        token_gen_latency = float(np.mean(np.concatenate(token_gen_latency_flat)))
 
     return ProfilingSummary(
         throughput, latency, token_gen_latency, first_token_latency, tokens_per_sec
@@ -12,7 +12,9 @@ import os
 from dataclasses import asdict
 from datetime import datetime
 from pathlib import Path
-from typing import Iterator, List
+from typing import Any, Iterator, List
+
+import numpy as np
 
 try:
     from .defaults import ARG_DEFAULTS, MODEL_DEFAULTS
@@ -110,9 +112,15 @@ def parse_args(
     client_parser.add_argument(
         "--warmup", type=int, default=1, help="Number of warmup requests to process"
     )
-    client_parser.add_argument(
+    client_concurrency_group = client_parser.add_mutually_exclusive_group()
+    client_concurrency_group.add_argument(
         "--use_thread", action="store_true", help="Use threads instead of processes"
     )
+    client_concurrency_group.add_argument(
+        "--use_asyncio",
+        action="store_true",
+        help="Run clients as coroutines on a single event loop instead of threads or processes",
+    )
     client_parser.add_argument(
         "--stream", action="store_true", help="Stream generated tokens"
     )
@@ -245,6 +253,13 @@ def print_summary(
     )
 
 
+def _json_default(obj: Any) -> Any:
+    # Per-token times are numpy arrays in memory
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
 def save_json_results(
     args: argparse.Namespace, response_details: List[ResponseDetails]
 ) -> None:
@@ -262,7 +277,7 @@ def save_json_results(
             "time": str(datetime.now()),
             "response_details": [asdict(r) for r in response_details],
         }
-        json.dump(data, f, indent=2)
+        json.dump(data, f, indent=2, default=_json_default)
 
 
 def results_exist(args: argparse.Namespace) -> bool: